@@ -1,13 +1,133 @@
+import copy
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
 from flask import Flask, render_template, request, jsonify
-from detector import DetectorPipeline
+from detector import CUDAGraphModel, DetectorPipeline
+
+try:
+    import intel_extension_for_pytorch as ipex
+except ImportError:
+    ipex = None
+
+# Serving never needs gradients
+torch.set_grad_enabled(False)
+torch.backends.cudnn.benchmark = True
+
+# Use every available core for intra-op parallelism on the CPU path, honouring
+# the CPU affinity gunicorn sets for each worker
+CPU_COUNT = (
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+)
+torch.set_num_threads(CPU_COUNT)
+torch.set_num_interop_threads(2)
+
+# Load the model once per process instead of on every request
+PIPELINE = DetectorPipeline()
+TOKENIZER, MODEL = PIPELINE.get_tokenizer_and_model(
+    "JosuMSC/fake-news-detector",
+    quantize=PIPELINE.device.type == "cpu" and ipex is None,
+)
+DEVICE = PIPELINE.device
+if DEVICE.type == "cuda":
+    # Half precision roughly doubles tensor core throughput on GPU
+    MODEL.half()
+    AUTOCAST_DTYPE = None
+elif ipex is not None:
+    AUTOCAST_DTYPE = torch.bfloat16
+else:
+    # Dynamic INT8 linear layers already take care of the precision
+    AUTOCAST_DTYPE = None
+if DEVICE.type == "cpu" and ipex is not None:
+    # oneDNN BF16 kernels, used together with the bfloat16 autocast above
+    MODEL = ipex.optimize(MODEL, dtype=torch.bfloat16)
+
+# Short to full length inputs, which also make a heavily padded batch together
+WARMUP_TEXTS = ["x " * (length - 2) for length in (32, 128, 512)]
+
+if DEVICE.type == "cpu":
+    # Padded micro-batches skip the pad tokens in the feed-forward layers.
+    # On GPU the CUDA graphs below need static shapes instead.
+    UNPADDED_MODEL = PIPELINE.unpad_ffn(copy.deepcopy(MODEL))
+    _, padded_logits = PIPELINE.predict_batch(
+        TOKENIZER, MODEL, WARMUP_TEXTS, autocast_dtype=AUTOCAST_DTYPE
+    )
+    _, unpadded_logits = PIPELINE.predict_batch(
+        TOKENIZER, UNPADDED_MODEL, WARMUP_TEXTS, autocast_dtype=AUTOCAST_DTYPE
+    )
+    # The tolerance leaves room for the rounding of BF16 and of the INT8
+    # activation ranges, which change once the pad tokens are left out
+    if torch.allclose(padded_logits, unpadded_logits, rtol=1e-2, atol=5e-2):
+        MODEL = UNPADDED_MODEL
+    else:
+        logging.getLogger(__name__).warning(
+            "Skipping padding in the feed-forward layers changed the logits "
+            "(%s != %s), serving the padded model instead",
+            padded_logits.tolist(),
+            unpadded_logits.tolist(),
+        )
+    del UNPADDED_MODEL
+
+# Warm up kernels, allocator and autotuning before serving the first request,
+# one input at a time and then as a padded batch
+for warmup_batch in [[text] for text in WARMUP_TEXTS] + [WARMUP_TEXTS]:
+    PIPELINE.predict_batch(
+        TOKENIZER, MODEL, warmup_batch, autocast_dtype=AUTOCAST_DTYPE
+    )
+
+# Replay captured CUDA graphs for the micro-batch shapes instead of launching
+# every kernel from Python
+if DEVICE.type == "cuda":
+    MODEL = CUDAGraphModel(MODEL)
+
+# Requests are grouped into micro-batches so concurrent texts share a forward pass
+MAX_BATCH_SIZE = 32
+MAX_WAIT_SECONDS = 0.005
+REQUEST_TIMEOUT_SECONDS = 30
+REQUESTS = queue.Queue()
+
+
+def batch_worker():
+    while True:
+        batch = [REQUESTS.get()]
+        deadline = time.monotonic() + MAX_WAIT_SECONDS
+        while len(batch) < MAX_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(REQUESTS.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        texts = [text for text, _ in batch]
+        try:
+            predictions, logits = PIPELINE.predict_batch(
+                TOKENIZER, MODEL, texts, autocast_dtype=AUTOCAST_DTYPE
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Any failure must resolve every waiting future, not kill the worker
+            for _, future in batch:
+                future.set_exception(e)
+            continue
+        for i, (_, future) in enumerate(batch):
+            future.set_result((predictions[i], logits[i : i + 1]))
+
+
+threading.Thread(target=batch_worker, daemon=True).start()
 
 app = Flask(__name__)
 
 
 def inference(text):
-    pipeline = DetectorPipeline()
-    tokenizer, model = pipeline.get_tokenizer_and_model("JosuMSC/fake-news-detector")
-    prediction, logits = pipeline.predict(tokenizer, model, text)
+    future = Future()
+    REQUESTS.put((text, future))
+    prediction, logits = future.result(timeout=REQUEST_TIMEOUT_SECONDS)
     logits = logits.cpu().detach().numpy().tolist()
     result = "Fake" if prediction == 0 else "Real"
     return result, logits
@@ -53,6 +53,24 @@ def predict(model: str, checkpoint: str, text: str):
     click.echo(f"Logits: {logits}")
 
 
+@click.command(name="export")
+@click.option(
+    "--checkpoint",
+    default="JosuMSC/fake-news-detector",
+    help="Model to export to ONNX.",
+)
+@click.option(
+    "--output", default="fake-news-detector", help="Name of the model to save."
+)
+@click.option(
+    "--optimize/--no-optimize", default=True, help="Apply ONNX Runtime fusions."
+)
+def export(checkpoint: str, output: str, optimize: bool):
+    pipeline = DetectorPipeline(checkpoint=checkpoint, model_name=output)
+    save_path = pipeline.export_onnx(optimize=optimize)
+    click.echo(f"ONNX model saved into directory ./{save_path}.")
+
+
 @click.command(name="publish")
 @click.option("--model", default="fake-news-detector", help="Model to publish.")
 def publish(model: str):
@@ -63,6 +81,7 @@ def publish(model: str):
 
 cli.add_command(train)
 cli.add_command(predict)
+cli.add_command(export)
 cli.add_command(publish)
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import os
+from functools import partial
 from tqdm import tqdm
 
 from transformers import (
@@ -6,18 +7,76 @@ from transformers import (
     AutoTokenizer,
     DataCollatorWithPadding,
     AutoModelForSequenceClassification,
-    AdamW,
 )
+from transformers.modeling_outputs import SequenceClassifierOutput
+from transformers.trainer_pt_utils import LengthGroupedSampler
 import datasets
+import numpy as np
 
-from typing import Tuple
+from typing import List, Tuple
 
 import torch
+from torch.optim import AdamW
 from torch.utils.data import DataLoader
 
 from sklearn.metrics import confusion_matrix, classification_report, f1_score
 
 
+def _tokenize(example: dict, tokenizer: AutoTokenizer) -> dict:
+    # Padding is left to the data collator so each batch is only padded
+    # to its own longest sequence
+    return tokenizer(example["text"], truncation=True)
+
+
+def _onnxruntime_has_cuda() -> bool:
+    # The CPU-only onnxruntime package cannot serve on GPU even on a CUDA host
+    import onnxruntime
+
+    return "CUDAExecutionProvider" in onnxruntime.get_available_providers()
+
+
+class UnpaddedFFN(torch.nn.Module):
+    def __init__(self, ffn: torch.nn.Module, min_padding: float = 0.2):
+        """Feed-forward layer wrapper that only runs on the non padding tokens.
+
+        :param ffn: Feed-forward layer to wrap.
+        :type ffn: torch.nn.Module
+        :param min_padding: Fraction of padding tokens above which padding is removed, defaults to 0.2
+        :type min_padding: float, optional
+        """
+        super().__init__()
+        self.ffn = ffn
+        self.min_padding = min_padding
+        self.attention_mask = None
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.attention_mask is None:
+            return self.ffn(x)
+        keep = self.attention_mask.bool()
+        # Gathering and scattering the tokens only pays off with enough padding
+        if 1 - keep.float().mean() < self.min_padding:
+            return self.ffn(x)
+        unpadded_output = self.ffn(x[keep])
+        output = unpadded_output.new_zeros(x.shape)
+        output[keep] = unpadded_output
+        return output
+
+
+def _forward_with_attention_mask(forward, unpadded_ffn: UnpaddedFFN):
+    # Hand the block attention mask over to its feed-forward layer
+    def wrapped_forward(*args, **kwargs):
+        unpadded_ffn.attention_mask = kwargs.get(
+            "attn_mask", args[1] if len(args) > 1 else None
+        )
+        try:
+            return forward(*args, **kwargs)
+        finally:
+            # Do not let the mask of this call leak into the next one
+            unpadded_ffn.attention_mask = None
+
+    return wrapped_forward
+
+
 class DetectorPipeline:
     def __init__(
         self,
@@ -37,6 +96,9 @@ class DetectorPipeline:
         self.dataset_name = dataset_name
         self.checkpoint = checkpoint
         self.model_name = model_name
+        self.device = (
+            torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        )
 
     def download_dataset(self) -> datasets.DatasetDict:
         """Download dataset from HuggingFace datasets library.
@@ -49,22 +111,85 @@ class DetectorPipeline:
         return dataset
 
     def get_tokenizer_and_model(
-        self, checkpoint: str = None
+        self, checkpoint: str = None, onnx: bool = False, quantize: bool = False
     ) -> Tuple[AutoTokenizer, AutoModelForSequenceClassification]:
         """Get tokenizer and model from model name.
 
         :param checkpoint: Name of the model to fine-tune, defaults to None
         :type checkpoint: str, optional
+        :param onnx: Whether to load an ONNX Runtime model exported with export_onnx instead of a PyTorch one, defaults to False
+        :type onnx: bool, optional
+        :param quantize: Whether to quantize the PyTorch model to INT8 for CPU inference. As the quantized model only runs on CPU, this also sets self.device to CPU, so later training or evaluation with this pipeline runs on CPU as well, defaults to False
+        :type quantize: bool, optional
         :return: Tokenizer and Model objects.
         :rtype: (AutoTokenizer, AutoModelForSequenceClassification)
         """
         model_name = checkpoint if checkpoint else self.checkpoint
         tokenizer = AutoTokenizer.from_pretrained(model_name)
-        model = AutoModelForSequenceClassification.from_pretrained(
-            model_name, num_labels=2
-        )
+        if onnx:
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+
+            # export_onnx saves the optimized graph next to the exported one
+            optimized_file = os.path.join(model_name, "model_optimized.onnx")
+            model = ORTModelForSequenceClassification.from_pretrained(
+                model_name,
+                file_name=(
+                    "model_optimized.onnx" if os.path.isfile(optimized_file) else None
+                ),
+                provider=(
+                    "CUDAExecutionProvider"
+                    if _onnxruntime_has_cuda()
+                    else "CPUExecutionProvider"
+                ),
+            )
+        else:
+            model = AutoModelForSequenceClassification.from_pretrained(
+                model_name, num_labels=2
+            )
+            model.eval()
+            if quantize:
+                # Quantized models only run on CPU, so inputs must go there too
+                self.device = torch.device("cpu")
+                model = self.quantize_model(model)
+            else:
+                model.to(self.device)
         return tokenizer, model
 
+    def quantize_model(
+        self, model: AutoModelForSequenceClassification
+    ) -> AutoModelForSequenceClassification:
+        """Quantize the linear layers of the model to INT8 for CPU inference.
+
+        :param model: Model to quantize.
+        :type model: AutoModelForSequenceClassification
+        :return: Quantized model, which can only run on CPU.
+        :rtype: AutoModelForSequenceClassification
+        """
+        model.to("cpu")
+        model.eval()
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    def unpad_ffn(
+        self, model: AutoModelForSequenceClassification, min_padding: float = 0.2
+    ) -> AutoModelForSequenceClassification:
+        """Make the feed-forward layers of a DistilBERT model skip padding tokens.
+        The patched model is meant for inference only, as its state dict keys change.
+
+        :param model: DistilBERT model to patch in place.
+        :type model: AutoModelForSequenceClassification
+        :param min_padding: Fraction of padding tokens in a batch above which padding is removed, defaults to 0.2
+        :type min_padding: float, optional
+        :return: Patched model.
+        :rtype: AutoModelForSequenceClassification
+        """
+        for block in model.distilbert.transformer.layer:
+            unpadded_ffn = UnpaddedFFN(block.ffn, min_padding=min_padding)
+            block.ffn = unpadded_ffn
+            block.forward = _forward_with_attention_mask(block.forward, unpadded_ffn)
+        return model
+
     def get_data_collator(self, tokenizer: AutoTokenizer) -> DataCollatorWithPadding:
         """Get data collator from tokenizer.
 
@@ -83,6 +208,7 @@ class DetectorPipeline:
         batch_size: int,
         tokenizer: AutoTokenizer,
         data_collator: DataCollatorWithPadding,
+        num_proc: int = None,
     ) -> Tuple[DataLoader, DataLoader, DataLoader]:
         """_summary_
 
@@ -94,38 +220,62 @@ class DetectorPipeline:
         :type DataLoader: AutoTokenizer
         :param data_collator: Data collator object.
         :type data_collator: DataCollatorWithPadding
+        :param num_proc: Number of processes used to tokenize the dataset when it is not cached in ./data/tokenized yet, if None, one per CPU is used, defaults to None
+        :type num_proc: int, optional
         :return: Dataloaders for train, validation and test splits.
         :rtype: (DataLoader, DataLoader, DataLoader)
         """
 
-        # Tokenize dataset
-        def tokenize_function(example):
-            return tokenizer(example["text"], truncation=True, padding=True)
-
-        tokenized_dataset = dataset.map(tokenize_function, batched=True)
+        # Tokenize dataset in parallel, one process per CPU by default, and keep
+        # it on disk so later runs with the same dataset and tokenizer skip it
+        cache_path = os.path.join(
+            "data",
+            "tokenized",
+            self.dataset_name.replace("/", "--"),
+            tokenizer.name_or_path.strip("/").replace("/", "--"),
+        )
+        if os.path.isdir(cache_path):
+            tokenized_dataset = datasets.load_from_disk(cache_path)
+        else:
+            tokenized_dataset = dataset.map(
+                partial(_tokenize, tokenizer=tokenizer),
+                batched=True,
+                batch_size=1000,
+                num_proc=num_proc if num_proc else os.cpu_count(),
+            )
+            tokenized_dataset.save_to_disk(cache_path)
 
         # Put in format that the model expects
         tokenized_dataset = tokenized_dataset.remove_columns(
             ["Unnamed: 0", "title", "text"]
         )
         tokenized_dataset = tokenized_dataset.rename_column("label", "labels")
+        train_lengths = [len(x) for x in tokenized_dataset["train"]["input_ids"]]
+        eval_lengths = [len(x) for x in tokenized_dataset["validation"]["input_ids"]]
         tokenized_dataset.set_format("torch")
 
-        # Create dataloaders
-        train_dataloader = DataLoader(
-            tokenized_dataset["train"],
-            shuffle=True,
+        # Create dataloaders, grouping train samples of similar length together.
+        # Batches are collated in background workers into pinned memory so the
+        # host to device copies can overlap with compute.
+        dataloader_kwargs = dict(
             batch_size=batch_size,
             collate_fn=data_collator,
+            pin_memory=torch.cuda.is_available(),
+            num_workers=4,
+            persistent_workers=True,
+            prefetch_factor=4,
         )
-        eval_dataloader = DataLoader(
-            tokenized_dataset["validation"],
-            batch_size=batch_size,
-            collate_fn=data_collator,
+        train_sampler = LengthGroupedSampler(batch_size, lengths=train_lengths)
+        train_dataloader = DataLoader(
+            tokenized_dataset["train"], sampler=train_sampler, **dataloader_kwargs
         )
-        test_dataloader = DataLoader(
-            tokenized_dataset["test"], batch_size=batch_size, collate_fn=data_collator
+        # Visit the validation split sorted by length so eval batches carry little
+        # padding, evaluate_model restores the dataset order from the sampler
+        eval_sampler = np.argsort(eval_lengths, kind="stable").tolist()
+        eval_dataloader = DataLoader(
+            tokenized_dataset["validation"], sampler=eval_sampler, **dataloader_kwargs
         )
+        test_dataloader = DataLoader(tokenized_dataset["test"], **dataloader_kwargs)
         return train_dataloader, eval_dataloader, test_dataloader
 
     def train_model(
@@ -161,13 +311,17 @@ class DetectorPipeline:
         num_training_steps = len(train_dataloader) * epochs
 
         # Set device
-        device = (
-            torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        )
-        model.to(device)
+        model.to(self.device)
 
         # Set optimizer
-        optimizer = AdamW(model.parameters(), lr=lr, weight_decay=weight_decay)
+        # The multi-tensor implementation updates all parameters in a few kernels
+        optimizer = AdamW(
+            model.parameters(),
+            lr=lr,
+            eps=1e-6,
+            weight_decay=weight_decay,
+            foreach=self.device.type == "cuda",
+        )
 
         # Set scheduler
         scheduler = get_scheduler(
@@ -177,21 +331,36 @@ class DetectorPipeline:
             num_training_steps=num_training_steps,
         )
 
+        # Use mixed precision on GPU, scaling the loss to avoid FP16 underflow
+        use_amp = self.device.type == "cuda"
+        scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
         # Train
-        pbar = tqdm(range(num_training_steps))
+        # Accumulate the loss on device so it is only synced when logged
+        running_loss = torch.zeros((), device=self.device)
         with tqdm(total=num_training_steps) as pbar:
             for _ in range(epochs):
                 model.train()
                 for batch in train_dataloader:
-                    batch = {k: v.to(device) for k, v in batch.items()}
-                    outputs = model(**batch)
-                    loss = outputs.loss
-                    loss.backward()
+                    batch = {
+                        k: v.to(self.device, non_blocking=True)
+                        for k, v in batch.items()
+                    }
+                    with torch.cuda.amp.autocast(enabled=use_amp):
+                        outputs = model(**batch)
+                        loss = outputs.loss
+                    scaler.scale(loss).backward()
+                    scaler.unscale_(optimizer)
                     torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
-                    optimizer.step()
+                    scaler.step(optimizer)
+                    scaler.update()
                     scheduler.step()
-                    optimizer.zero_grad()
+                    optimizer.zero_grad(set_to_none=True)
+                    running_loss += loss.detach()
                     pbar.update(1)
+                    if pbar.n % 50 == 0:
+                        pbar.set_postfix(loss=(running_loss / 50).item())
+                        running_loss.zero_()
 
         return model
 
@@ -214,31 +383,34 @@ class DetectorPipeline:
         """
 
         # Set device
-        device = (
-            torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        )
-        model.to(device)
+        model.to(self.device)
 
         # Evaluate
         model.eval()
-        predictions = []
+        labels = np.asarray(dataset["validation"]["label"])
+        running_predictions = []
 
         for batch in dataloader:
-            batch = {k: v.to(device) for k, v in batch.items()}
-            with torch.no_grad():
+            batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+            with torch.inference_mode():
                 outputs = model(**batch)
             logits = outputs.logits
-            running_predictions = (
-                torch.argmax(logits, dim=-1).to("cpu").numpy().tolist()
-            )
-            predictions.extend(running_predictions)
+            # Keep predictions on device to avoid a sync on every batch
+            running_predictions.append(torch.argmax(logits, dim=-1))
+        predictions = torch.cat(running_predictions).cpu().numpy()
+
+        # Undo the length sorting of the sampler built by get_dataloaders
+        if isinstance(dataloader.sampler, list):
+            sorted_predictions = predictions
+            predictions = np.empty_like(sorted_predictions)
+            predictions[dataloader.sampler] = sorted_predictions
 
         # Print results
         print("Results of the model:\n")
-        f1score = f1_score(dataset["validation"]["label"], predictions, average="macro")
+        f1score = f1_score(labels, predictions, average="macro")
         print(f"F1 score: {f1score}")
-        print(classification_report(dataset["validation"]["label"], predictions))
-        print(confusion_matrix(dataset["validation"]["label"], predictions))
+        print(classification_report(labels, predictions))
+        print(confusion_matrix(labels, predictions))
 
         return f1score
 
@@ -291,13 +463,17 @@ class DetectorPipeline:
         model = AutoModelForSequenceClassification.from_pretrained(
             load_path, local_files_only=True
         )
+        model.to(self.device)
+        model.eval()
         return tokenizer, model
 
+    @torch.inference_mode()
     def predict(
         self,
         tokenizer: AutoTokenizer,
         model: AutoModelForSequenceClassification,
         text: str,
+        autocast_dtype: torch.dtype = None,
     ) -> int:
         """Predict class of text.
 
@@ -307,27 +483,91 @@ class DetectorPipeline:
         :type model: AutoModelForSequenceClassification
         :param text: Text to predict.
         :type text: str
+        :param autocast_dtype: Lower precision dtype to run the forward pass with, if None the model runs in its own precision, defaults to None
+        :type autocast_dtype: torch.dtype, optional
         :return: Predicted class.
         :rtype: int
         """
-        # Set device
-        device = (
-            torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        )
-        model.to(device)
-
         # Predict
-        model.eval()
-        encoded_text = tokenizer(
-            text, truncation=True, padding=True, return_tensors="pt"
-        )
-        encoded_text = {k: v.to(device) for k, v in encoded_text.items()}
-        with torch.no_grad():
+        encoded_text = tokenizer(text, truncation=True, return_tensors="pt")
+        encoded_text = {k: v.to(self.device) for k, v in encoded_text.items()}
+        with torch.autocast(
+            self.device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+        ):
             outputs = model(**encoded_text)
-        logits = outputs.logits
+        logits = outputs.logits.float()
         prediction = torch.argmax(logits, dim=-1).to("cpu").numpy().tolist()[0]
         return prediction, logits
 
+    @torch.inference_mode()
+    def predict_batch(
+        self,
+        tokenizer: AutoTokenizer,
+        model: AutoModelForSequenceClassification,
+        texts: List[str],
+        autocast_dtype: torch.dtype = None,
+    ) -> Tuple[List[int], torch.Tensor]:
+        """Predict class of several texts with a single forward pass.
+
+        :param tokenizer: Tokenizer to use for prediction.
+        :type tokenizer: AutoTokenizer
+        :param model: Model to use for prediction.
+        :type model: AutoModelForSequenceClassification
+        :param texts: Texts to predict.
+        :type texts: List[str]
+        :param autocast_dtype: Lower precision dtype to run the forward pass with, if None the model runs in its own precision, defaults to None
+        :type autocast_dtype: torch.dtype, optional
+        :return: Predicted classes and logits, one row per text.
+        :rtype: (List[int], torch.Tensor)
+        """
+        # Predict
+        encoded_texts = tokenizer(
+            texts, truncation=True, padding=True, return_tensors="pt"
+        )
+        encoded_texts = {k: v.to(self.device) for k, v in encoded_texts.items()}
+        with torch.autocast(
+            self.device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+        ):
+            outputs = model(**encoded_texts)
+        logits = outputs.logits.float()
+        predictions = torch.argmax(logits, dim=-1).to("cpu").numpy().tolist()
+        return predictions, logits
+
+    def export_onnx(self, checkpoint: str = None, optimize: bool = True) -> str:
+        """Export model to ONNX and save it to be served with ONNX Runtime.
+
+        :param checkpoint: Name or path of the model to export, if None, self.checkpoint is used, defaults to None.
+        :type checkpoint: str, optional
+        :param optimize: Whether to apply ONNX Runtime graph fusions to the exported model, defaults to True.
+        :type optimize: bool, optional
+        :return: Directory where the exported model is saved.
+        :rtype: str
+        """
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTOptimizer
+        from optimum.onnxruntime.configuration import OptimizationConfig
+
+        model_name = checkpoint if checkpoint else self.checkpoint
+        save_path = os.path.join("models", "onnx", self.model_name)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = ORTModelForSequenceClassification.from_pretrained(
+            model_name, export=True
+        )
+        model.save_pretrained(save_path)
+        tokenizer.save_pretrained(save_path)
+
+        if optimize:
+            # FP16 conversion is only worth it when ONNX Runtime can serve on GPU
+            on_gpu = _onnxruntime_has_cuda()
+            optimization_config = OptimizationConfig(
+                optimization_level=99, optimize_for_gpu=on_gpu, fp16=on_gpu
+            )
+            optimizer = ORTOptimizer.from_pretrained(model)
+            optimizer.optimize(
+                save_dir=save_path, optimization_config=optimization_config
+            )
+
+        return save_path
+
     def publish_model_from_directory(self, model_name: str = None) -> None:
         """Publish model to Hugging Face Hub from the specified directory.
         Both the model in the directory and the model on the Hub must have the same name.
@@ -342,3 +582,84 @@ class DetectorPipeline:
         tokenizer.push_to_hub(model_name)
         model.push_to_hub(model_name)
         return None
+
+
+class CUDAGraphModel:
+    def __init__(
+        self,
+        model: AutoModelForSequenceClassification,
+        batch_sizes: Tuple[int, ...] = (1, 4, 8, 16, 32),
+        sequence_lengths: Tuple[int, ...] = (64, 128, 256, 512),
+    ):
+        """Wrapper that runs a model on GPU by replaying CUDA graphs captured
+        for a fixed set of input shapes, removing the per-kernel launch overhead.
+        Inputs are padded up to the closest captured shape, and larger inputs
+        fall back to the eager model.
+
+        :param model: Model to capture, already on GPU and in eval mode.
+        :type model: AutoModelForSequenceClassification
+        :param batch_sizes: Batch sizes to capture, defaults to (1, 4, 8, 16, 32)
+        :type batch_sizes: Tuple[int, ...], optional
+        :param sequence_lengths: Sequence lengths to capture, defaults to (64, 128, 256, 512)
+        :type sequence_lengths: Tuple[int, ...], optional
+        """
+        self.model = model
+        self.batch_sizes = sorted(batch_sizes)
+        self.sequence_lengths = sorted(sequence_lengths)
+        self.graphs = {}
+
+        # Capture the largest shapes first so the smaller graphs can share
+        # their memory pool
+        pool = None
+        with torch.inference_mode():
+            for batch_size in reversed(self.batch_sizes):
+                for sequence_length in reversed(self.sequence_lengths):
+                    input_ids = torch.zeros(
+                        (batch_size, sequence_length), dtype=torch.long, device="cuda"
+                    )
+                    attention_mask = torch.ones_like(input_ids)
+
+                    # Warm up on a side stream before capturing
+                    stream = torch.cuda.Stream()
+                    stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(stream):
+                        for _ in range(3):
+                            model(input_ids=input_ids, attention_mask=attention_mask)
+                    torch.cuda.current_stream().wait_stream(stream)
+
+                    graph = torch.cuda.CUDAGraph()
+                    with torch.cuda.graph(graph, pool=pool):
+                        logits = model(
+                            input_ids=input_ids, attention_mask=attention_mask
+                        ).logits
+                    pool = graph.pool()
+                    self.graphs[(batch_size, sequence_length)] = (
+                        graph,
+                        input_ids,
+                        attention_mask,
+                        logits,
+                    )
+
+    def __call__(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> SequenceClassifierOutput:
+        batch_size, sequence_length = input_ids.shape
+        captured_batch_size = next(
+            (size for size in self.batch_sizes if size >= batch_size), None
+        )
+        captured_sequence_length = next(
+            (size for size in self.sequence_lengths if size >= sequence_length), None
+        )
+        if captured_batch_size is None or captured_sequence_length is None:
+            return self.model(input_ids=input_ids, attention_mask=attention_mask)
+
+        graph, static_input_ids, static_attention_mask, static_logits = self.graphs[
+            (captured_batch_size, captured_sequence_length)
+        ]
+        static_input_ids.zero_()
+        static_attention_mask.zero_()
+        static_input_ids[:batch_size, :sequence_length].copy_(input_ids)
+        static_attention_mask[:batch_size, :sequence_length].copy_(attention_mask)
+        graph.replay()
+        # The static output is overwritten by the next replay
+        return SequenceClassifierOutput(logits=static_logits[:batch_size].clone())
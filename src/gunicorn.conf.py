@@ -0,0 +1,42 @@
+# Description: Gunicorn configuration to serve the fake news detector API.
+import itertools
+import os
+
+bind = "0.0.0.0:5000"
+
+# A single worker keeps one copy of the model in memory, its threads feed the
+# micro-batching queue. For CPU serving, more workers can be started and each
+# of them is pinned to its own group of cores.
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+worker_class = "gthread"
+
+# Each worker loads the app itself, as the micro-batching thread would not
+# survive a fork from a preloaded master. Workers download and warm up the
+# model before answering any request, hence the long timeout.
+preload_app = False
+timeout = 300
+
+
+def pre_fork(server, worker):
+    # Give the new worker the first core group not held by a live worker, so a
+    # replacement for a crashed worker takes over the cores it left behind
+    used_groups = {
+        getattr(live_worker, "cpu_group", None)
+        for live_worker in server.WORKERS.values()
+    }
+    worker.cpu_group = next(
+        group for group in itertools.count() if group not in used_groups
+    )
+
+
+def post_fork(server, worker):
+    # The live worker count also follows -w on the command line and TTIN/TTOU
+    num_workers = server.num_workers
+    if num_workers > 1 and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        group_size = max(len(cores) // num_workers, 1)
+        group = worker.cpu_group % num_workers
+        worker_cores = cores[group * group_size : (group + 1) * group_size] or cores
+        os.sched_setaffinity(0, worker_cores)
+        server.log.info("Worker %s pinned to cores %s", worker.pid, worker_cores)